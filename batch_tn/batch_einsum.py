@@ -1,10 +1,19 @@
+import heapq
+import itertools
+import logging
+import math
+import weakref
+import numpy as np
 from typing import Optional
 from collections import defaultdict
-from cotengra import einsum_tree
+from concurrent.futures import ThreadPoolExecutor
+from cotengra import einsum_tree, get_symbol
 from cotengra.contract import extract_contractions
 from cotengra.contract import einsum as ctg_einsum
 from autoray import do
-from functools import lru_cache
+from functools import lru_cache, partial
+
+logger = logging.getLogger(__name__)
 
 def get_result_shape(eq, shapes):
     inputs, output = eq.split('->')
@@ -23,6 +32,7 @@ def get_result_shape(eq, shapes):
                 raise ValueError(f"Size mismatch for character {c}: {size_dict[c]} vs {size}")
     return [size_dict[c] for c in output]
 
+@lru_cache(maxsize=None)
 def get_batched_einsum_equation(original_eq: str, batch_symbol: Optional[str] = None) -> str:
     """
     Convert an einsum equation to a batched version by prepending a batch symbol.
@@ -55,97 +65,587 @@ def get_batched_einsum_equation(original_eq: str, batch_symbol: Optional[str] =
 
     return f"{','.join(batched_terms)}->{batched_output}"
 
-def get_batched_contractions(contractions_batch, shapes_batch):
+@lru_cache(maxsize=None)
+def _parse_gemm(eq: str):
+    """
+    Check whether a binary einsum equation is a plain matrix multiplication
+    up to transpositions, i.e. every shared index is contracted, every other
+    index is kept, and no index is repeated within a term.
+
+    Returns
+    -------
+    tuple or None
+        ``None`` if the equation is not a GEMM, otherwise
+        ``(perm_left, perm_right, n_keep_left, n_con, perm_out)`` giving the
+        axis permutations (batch axis included) that bring the left and right
+        operands into ``(B, M..., K...)`` and ``(B, K..., N...)`` order, and
+        the permutation of the ``(B, M..., N...)`` result into the output order.
+    """
+    inputs, output = eq.split('->')
+    terms = inputs.split(',')
+    if len(terms) != 2:
+        return None
+    left, right = terms
+    if any(len(set(term)) != len(term) for term in (left, right, output)):
+        return None
+
+    con = [c for c in left if c in right]
+    keep_left = [c for c in left if c not in right]
+    keep_right = [c for c in right if c not in left]
+    if not con or any(c in output for c in con):
+        return None
+    if sorted(keep_left + keep_right) != sorted(output):
+        return None
+
+    perm_left = (0,) + tuple(1 + left.index(c) for c in keep_left + con)
+    perm_right = (0,) + tuple(1 + right.index(c) for c in con + keep_right)
+    kept = keep_left + keep_right
+    perm_out = (0,) + tuple(1 + kept.index(c) for c in output)
+    return perm_left, perm_right, len(keep_left), len(con), perm_out
+
+def _batched_gemm(gemm, stack_left, stack_right, out=None):
+    """
+    Contract two stacks via a single batched matrix multiplication,
+    optionally writing the result into `out`.
+    """
+    perm_left, perm_right, n_keep_left, n_con, perm_out = gemm
+
+    if perm_left != tuple(range(len(perm_left))):
+        stack_left = np.transpose(stack_left, perm_left)
+    if perm_right != tuple(range(len(perm_right))):
+        stack_right = np.transpose(stack_right, perm_right)
+
+    B = stack_left.shape[0]
+    shape_m = tuple(stack_left.shape[1:1 + n_keep_left])
+    shape_k = tuple(stack_left.shape[1 + n_keep_left:])
+    shape_n = tuple(stack_right.shape[1 + n_con:])
+
+    stack_left = stack_left.reshape(B, math.prod(shape_m), math.prod(shape_k))
+    stack_right = stack_right.reshape(B, math.prod(shape_k), math.prod(shape_n))
+
+    if perm_out == tuple(range(len(perm_out))):
+        # write straight into the preallocated output, no final transposition
+        if out is None:
+            out = np.empty((B,) + shape_m + shape_n, dtype=np.result_type(stack_left, stack_right))
+        np.matmul(stack_left, stack_right, out=out.reshape(stack_left.shape[:2] + stack_right.shape[2:]))
+        return out
+
+    result = np.matmul(stack_left, stack_right).reshape((B,) + shape_m + shape_n)
+    result = np.transpose(result, perm_out)
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
+
+def _relabel(eq):
+    """
+    Rename the indices of an einsum equation in order of first appearance.
+    """
+    symbols = {}
+    for c in eq:
+        if c not in ',->' and c not in symbols:
+            symbols[c] = get_symbol(len(symbols))
+    return ''.join(symbols.get(c, c) for c in eq)
+
+def _layout_penalty(eq):
+    """
+    Rank how far a pairwise equation is from a plain batched matmul: whether
+    its result needs a final transposition, and how many operands need one.
+    """
+    gemm = _parse_gemm(eq)
+    if gemm is None:
+        return (0, 0)
+    perm_left, perm_right, _, _, perm_out = gemm
+    is_identity = [perm == tuple(range(len(perm))) for perm in (perm_out, perm_left, perm_right)]
+    return (not is_identity[0], 2 - is_identity[1] - is_identity[2])
+
+@lru_cache(maxsize=None)
+def _canonicalize_equation(eq, shape_left, dtype_left, shape_right, dtype_right):
+    """
+    Bring a pairwise contraction into a canonical form, so that contractions
+    differing only by the order of their operands or by index names share a
+    signature. The indices are renamed in order of first appearance, and the
+    operand order needing the fewest transpositions on the GEMM path is
+    chosen, with ties going to the operand with the larger shape first.
+
+    Returns
+    -------
+    tuple of (str, bool)
+        The canonical equation and whether the operands are swapped.
+    """
+    inputs, output = eq.split('->')
+    term_left, term_right = inputs.split(',')
+    straight = _relabel(eq)
+    swapped = _relabel(f"{term_right},{term_left}->{output}")
+    penalty_straight = tuple(-x for x in _layout_penalty(straight))
+    penalty_swapped = tuple(-x for x in _layout_penalty(swapped))
+    swap = (penalty_swapped, shape_right, shape_left, swapped, str(dtype_right), str(dtype_left)) > (
+        penalty_straight, shape_left, shape_right, straight, str(dtype_left), str(dtype_right)
+    )
+    return (swapped if swap else straight), swap
+
+_LEAF_CACHE = []
+
+def _leaf(n):
+    """
+    Return the node of the `n`-th input as used by cotengra, `frozenset([n])`,
+    from a process-wide cache so leaves are not rebuilt and rehashed per tree.
+    """
+    if n >= len(_LEAF_CACHE):
+        _LEAF_CACHE.extend(frozenset([i]) for i in range(len(_LEAF_CACHE), n + 1))
+    return _LEAF_CACHE[n]
+
+def _intern(table, items, item):
+    """
+    Return the integer id of `item`, assigning the next free id if it is new.
+    """
+    item_id = table.setdefault(item, len(items))
+    if item_id == len(items):
+        items.append(item)
+    return item_id
+
+def _schedule(node_parent, node_sig, node_pending, node_count, node_scores):
+    """
+    Greedily order the contractions of a forest of trees given as flat integer
+    lists indexed by node id, always picking the signature with the highest
+    score, i.e. the sum of the scores of its ready contractions, with ties
+    broken by the number of ready contractions. Only plain numeric
+    bookkeeping happens here.
+
+    Each node stands for the same node of `node_count` identical trees. Such
+    trees always sit in the same buckets, so scheduling one copy weighted by
+    its count is equivalent to scheduling all of them.
+
+    Parameters
+    ----------
+    node_parent : list of int
+        The parent of each node, -1 for roots.
+    node_sig : list of int
+        The signature id of the contraction producing each node, -1 for leaves.
+    node_pending : list of int
+        The number of children of each node not yet contracted. Updated in place.
+    node_count : list of int
+        The number of identical trees each node stands for.
+    node_scores : list of float
+        The score of the contraction producing each node, per tree.
+
+    Returns
+    -------
+    list of (int, list of int)
+        The signature id and the parent node ids of each batched contraction.
+    """
+    # Max-heap of (-score, -bucket size, tiebreaker, sig) with lazy deletion:
+    # an entry is pushed once for every bucket that grew in an iteration, and
+    # is discarded on pop unless it is the latest entry of its bucket. Sizes
+    # alone cannot tell, as a bucket may regrow to the size of a stale entry
+    # with a different score.
+    contractible = defaultdict(list)
+    bucket_sizes = defaultdict(int)
+    bucket_scores = defaultdict(float)
+    for p, sig in enumerate(node_sig):
+        if sig >= 0 and node_pending[p] == 0:
+            contractible[sig].append(p)
+            bucket_sizes[sig] += node_count[p]
+            bucket_scores[sig] += node_count[p] * node_scores[p]
+
+    heap = []
+    latest = {}
+    counter = itertools.count()
+    for sig, size in bucket_sizes.items():
+        latest[sig] = next(counter)
+        heap.append((-bucket_scores[sig], -size, latest[sig], sig))
+    heapq.heapify(heap)
+
+    order = []
+    while heap:
+        _, _, entry, sig = heapq.heappop(heap)
+        if latest.get(sig) != entry:
+            continue
+        parents = contractible.pop(sig)
+        del bucket_sizes[sig], bucket_scores[sig], latest[sig]
+        order.append((sig, parents))
+
+        grown = set()
+        for p in parents:
+            # Check if this parent can now be contracted with its sibling
+            grandparent = node_parent[p]
+            if grandparent >= 0:
+                node_pending[grandparent] -= 1
+                if node_pending[grandparent] == 0:
+                    contractible[node_sig[grandparent]].append(grandparent)
+                    bucket_sizes[node_sig[grandparent]] += node_count[grandparent]
+                    bucket_scores[node_sig[grandparent]] += node_count[grandparent] * node_scores[grandparent]
+                    grown.add(node_sig[grandparent])
+
+        for sig in grown:
+            latest[sig] = next(counter)
+            heapq.heappush(heap, (-bucket_scores[sig], -bucket_sizes[sig], latest[sig], sig))
+
+    return order
+
+def _numpy_dtype(dtype):
+    """
+    Return `dtype` as a numpy dtype, or None if numpy does not know it, e.g.
+    the name 'bfloat16' of a torch or jax dtype.
+    """
+    if dtype is None or isinstance(dtype, tuple):
+        return None
+    try:
+        return np.dtype(dtype)
+    except TypeError:
+        return None
+
+def _result_dtype(dtype_left, dtype_right):
+    """
+    The dtype of the result of contracting operands of the given dtypes.
+
+    Dtypes numpy does not know are opaque keys: equal dtypes give the same
+    dtype, and a mixed pair is keyed by both.
+    """
+    if dtype_left == dtype_right:
+        return dtype_left
+    numpy_left, numpy_right = _numpy_dtype(dtype_left), _numpy_dtype(dtype_right)
+    if numpy_left is None or numpy_right is None:
+        return tuple(sorted((dtype_left, dtype_right), key=str))
+    return np.result_type(numpy_left, numpy_right)
+
+def _operand_bytes(shape, dtype):
+    """
+    The number of bytes of an operand, or of elements if its dtype is unknown
+    or not a numpy dtype.
+    """
+    numpy_dtype = _numpy_dtype(dtype)
+    return math.prod(shape) * (1 if numpy_dtype is None else numpy_dtype.itemsize)
+
+def get_batched_contractions(contractions_batch, shapes_batch, dtypes_batch=None, alpha=1.0, beta=0.0):
     """
     Generate a list of batched contractions given a collection of contractions from `extract_contractions`.
 
     Arguments:
     - contractions_batch: A list of lists, where each inner list contains tuples of the form
       (parent, left, right, eq) representing the contractions.
+    - shapes_batch: A list of lists of the shapes of the input arrays of each tree.
+    - dtypes_batch: Optionally, a list of lists of the dtypes of the input arrays of each tree.
+      Contractions are then only batched together if their operand dtypes match, so that
+      operands are never upcast to the widest dtype in a mixed batch.
+    - alpha, beta: Weights of the greedy score of a batch of ready contractions,
+      `alpha * batch_size - beta * delta_bytes`, where `delta_bytes` is the change in live
+      memory from contracting the whole batch (results allocated minus intermediate operands
+      released; input arrays are held by the caller and never released).
+      The default `beta=0` always picks the largest batch; `beta > 0` favours batches that
+      free memory, lowering the peak memory at the cost of smaller batches.
     """
 
-    node2shape_batch = [{frozenset([n]): arr for n, arr in enumerate(shapes)} for shapes in shapes_batch]
-    
-    node2children_batch = []
-    node2parent_batch = []
-    node2eq = []
-    
-    for contractions in contractions_batch:
-        children_map = {}
-        parent_map = {}
-        eq_map = {}
-        
+    # Trees with the same contractions and input shapes and dtypes are
+    # scheduled as one, weighted by their count, and expanded afterwards.
+    # Nodes of every distinct tree are interned to consecutive integer ids, with the
+    # tree structure kept in flat lists indexed by node id (-1 for none).
+    # Equations, operands (shape, dtype) and signatures (eq_id, left_operand_id,
+    # right_operand_id) are interned too, with signatures in canonical form so
+    # that e.g. 'ab,bc->ac' and 'bc,ab->ac' share a batch. Children always
+    # precede their parent, so every node operand and signature is known
+    # before scheduling starts.
+    eq_table = {}
+    operand_table = {}
+    sig_table = {}
+    eqs = []
+    operands = []
+    sigs = []
+    sig_results = []
+    canonical_sigs = {}
+    group_of = {}
+    group_trees = []
+    node_keys = []
+    node_tree = []
+    node_operand = []
+    node_parent = []
+    node_left = []
+    node_right = []
+    node_sig = []
+    node_pending = []
+
+    if dtypes_batch is None:
+        dtypes_batch = [[None] * len(shapes) for shapes in shapes_batch]
+
+    for i, (contractions, shapes, dtypes) in enumerate(zip(contractions_batch, shapes_batch, dtypes_batch)):
+        # Keyed by identity of the contraction list, as `get_contractions` hands
+        # out the same cached list for repeated equations.
+        group_key = (id(contractions), tuple(map(tuple, shapes)), tuple(dtypes))
+        g = group_of.get(group_key)
+        if g is not None:
+            group_trees[g].append(i)
+            continue
+        g = group_of[group_key] = len(group_trees)
+        group_trees.append([i])
+
+        node_id_of = {}
+        for n, (shape, dtype) in enumerate(zip(shapes, dtypes)):
+            node_id_of[_leaf(n)] = len(node_keys)
+            node_keys.append(_leaf(n))
+            node_tree.append(g)
+            node_operand.append(_intern(operand_table, operands, (tuple(shape), dtype)))
+            node_parent.append(-1)
+            node_left.append(-1)
+            node_right.append(-1)
+            node_sig.append(-1)
+            node_pending.append(0)
+
         for parent, left, right, eq in contractions:
             if left is not None and right is not None:
-                children_map[parent] = (left, right)
-                parent_map[left] = parent
-                parent_map[right] = parent
-                eq_map[parent] = eq
+                left, right = node_id_of[left], node_id_of[right]
+                raw_key = (_intern(eq_table, eqs, eq), node_operand[left], node_operand[right])
+                if raw_key not in canonical_sigs:
+                    canonical_eq, swap = _canonicalize_equation(eq, *operands[raw_key[1]], *operands[raw_key[2]])
+                    operand_left, operand_right = raw_key[1:] if not swap else raw_key[:0:-1]
+                    key = (_intern(eq_table, eqs, canonical_eq), operand_left, operand_right)
+                    sig = _intern(sig_table, sigs, key)
+                    if sig == len(sig_results):
+                        shape_left, dtype_left = operands[operand_left]
+                        shape_right, dtype_right = operands[operand_right]
+                        result_shape = tuple(get_result_shape(canonical_eq, [shape_left, shape_right]))
+                        result_dtype = _result_dtype(dtype_left, dtype_right)
+                        sig_results.append(_intern(operand_table, operands, (result_shape, result_dtype)))
+                    canonical_sigs[raw_key] = (sig, swap)
+                sig, swap = canonical_sigs[raw_key]
+                if swap:
+                    left, right = right, left
 
-        node2children_batch.append(children_map)
-        node2parent_batch.append(parent_map)
-        node2eq.append(eq_map)
+                p = len(node_keys)
+                node_id_of[parent] = p
+                node_keys.append(parent)
+                node_tree.append(g)
+                node_operand.append(sig_results[sig])
+                node_parent.append(-1)
+                node_left.append(left)
+                node_right.append(right)
+                node_sig.append(sig)
+                node_pending.append((node_sig[left] >= 0) + (node_sig[right] >= 0))
+                node_parent[left] = p
+                node_parent[right] = p
 
-    contractible = defaultdict(list)
-    for i, (contractions, node2shape) in enumerate(zip(contractions_batch, node2shape_batch)):
-        for parent, left, right, eq in contractions:
-            if left in node2shape and right in node2shape:
-                shape_left = node2shape[left]
-                shape_right = node2shape[right]
-                key = (eq, tuple(shape_left), tuple(shape_right))
-                target = (i, parent, left, right)
-                contractible[key].append(target)
+    # Every intermediate has a single consumer, so contracting a node releases
+    # its intermediate operands. Leaves are still held by the caller and are
+    # never released.
+    operand_bytes = [_operand_bytes(*operand) for operand in operands]
+    node_scores = [0.0] * len(node_sig)
+    for p, sig in enumerate(node_sig):
+        if sig >= 0:
+            delta_bytes = operand_bytes[node_operand[p]]
+            for child in (node_left[p], node_right[p]):
+                if node_sig[child] >= 0:
+                    delta_bytes -= operand_bytes[node_operand[child]]
+            node_scores[p] = alpha - beta * delta_bytes
 
-    batched_contractions = []
-    while contractible:
-        key = max(contractible, key=lambda k: len(contractible[k]))
-        targets = contractible.pop(key)
-        eq, shape_left, shape_right = key
+    node_count = [len(group_trees[g]) for g in node_tree]
 
+    batched_contractions = []
+    for sig, parents in _schedule(node_parent, node_sig, node_pending, node_count, node_scores):
+        eq = eqs[sigs[sig][0]]
+        targets = [
+            (i, node_keys[p], node_keys[node_left[p]], node_keys[node_right[p]])
+            for p in parents
+            for i in group_trees[node_tree[p]]
+        ]
         batched_contractions.append((eq, targets))
-        result_shape = get_result_shape(eq, [shape_left, shape_right])
 
-        for i, parent, left, right in targets:
-            node2shape_batch[i].pop(left)
-            node2shape_batch[i].pop(right)
-            node2shape_batch[i][parent] = result_shape
+    return batched_contractions
 
-            # Check if this parent can now be contracted with its sibling
-            grandparent = node2parent_batch[i].get(parent, None)
-            if grandparent is not None:
-                grand_left, grand_right = node2children_batch[i][grandparent]
-                if grand_left in node2shape_batch[i] and grand_right in node2shape_batch[i]:
-                    # Get shapes in the correct order according to original contraction
-                    shape_left = node2shape_batch[i][grand_left]
-                    shape_right = node2shape_batch[i][grand_right]
-                    eq = node2eq[i][grandparent]
-                    key = (eq, tuple(shape_left), tuple(shape_right))
-                    target = (i, grandparent, grand_left, grand_right)
-                    contractible[key].append(target)
+def _pop_inputs(targets, node2array_batch):
+    """
+    Remove the operands of a batched contraction from `node2array_batch`.
 
-    return batched_contractions
+    Pairs of operands that are the very same array objects are only returned
+    once, along with the index of the unique pair used by each target, so that
+    shared sub-contractions are computed a single time.
+    """
+    arrays_left, arrays_right, inverse = [], [], []
+    pair_index = {}
+    for network_idx, parent, left, right in targets:
+        array_left = node2array_batch[network_idx].pop(left)
+        array_right = node2array_batch[network_idx].pop(right)
+        k = pair_index.setdefault((id(array_left), id(array_right)), len(arrays_left))
+        if k == len(arrays_left):
+            arrays_left.append(array_left)
+            arrays_right.append(array_right)
+        inverse.append(k)
+    return arrays_left, arrays_right, inverse
+
+def _output_rows(arrays, outputs):
+    """
+    Return the batched output the arrays are all whole rows of, along with
+    their row indices, or None if they are not.
 
-def _batched_einsum(eq, targets, node2array_batch):
+    Only buffers registered in `outputs`, a dict of weak references keyed by
+    id, are considered, so views the caller made of their own buffers are
+    never mistaken for rows.
     """
-    Perform batched binary contraction for a given equation.
+    base = arrays[0].base
+    ref = outputs.get(id(base))
+    if ref is None or ref() is not base:
+        return None
+    if not (
+        base.flags.c_contiguous
+        and base.dtype == arrays[0].dtype
+        and base.shape[1:] == arrays[0].shape
+        and all(array.base is base and array.strides == base.strides[1:] for array in arrays)
+    ):
+        return None
+    start, row_bytes = base.ctypes.data, base.strides[0]
+    rows = []
+    for array in arrays:
+        row, remainder = divmod(array.ctypes.data - start, row_bytes)
+        if remainder or not 0 <= row < len(base):
+            return None
+        rows.append(row)
+    return base, rows
+
+def _stack(arrays, outputs=None):
     """
-    batched_eq = get_batched_einsum_equation(eq)
+    Stack arrays of the same shape into one contiguous array.
 
-    arrays_left, arrays_right = [], []
-    for network_idx, parent, left, right in targets:
-        arrays_left.append(node2array_batch[network_idx].pop(left))
-        arrays_right.append(node2array_batch[network_idx].pop(right))
+    Arrays that are all rows of the same batched output in `outputs` (see
+    `_output_rows`) are gathered from it
+    with a single `np.take`, or sliced from it without any copy if they are
+    consecutive rows in order. Otherwise each array is copied into a preallocated buffer.
+    """
+    gathered = None if outputs is None else _output_rows(arrays, outputs)
+    if gathered is not None:
+        base, rows = gathered
+        if rows == list(range(rows[0], rows[0] + len(rows))):
+            return base[rows[0]:rows[0] + len(rows)]
+        return np.take(base, rows, axis=0)
+
+    stack = np.empty((len(arrays),) + arrays[0].shape, dtype=np.result_type(*arrays))
+    for i, array in enumerate(arrays):
+        # index with `...` so scalar operands still give a writeable 0-d view
+        np.copyto(stack[i, ...], array)
+    return stack
+
+def _stack_inputs(arrays_left, arrays_right, outputs=None):
+    """
+    Stack the left and right operands of a batched contraction.
+    """
+    return _stack(arrays_left, outputs), _stack(arrays_right, outputs)
+
+def _batched_cost(eq, shape_left, shape_right):
+    """
+    Count the scalar multiply-adds of a pairwise einsum, i.e. the product of
+    the sizes of all distinct indices.
+    """
+    terms = eq.split('->')[0].split(',')
+    size_dict = dict(zip(terms[0], shape_left))
+    size_dict.update(zip(terms[1], shape_right))
+    return math.prod(size_dict.values())
+
+def _einsum_into(batched_eq, stack_left, stack_right, out=None):
+    """
+    Contract two stacks with `ctg_einsum`, optionally copying the result into `out`.
+    """
+    result = ctg_einsum(batched_eq, stack_left, stack_right)
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
 
+def _einsum_diagonal(batched_eq, stack_left, stack_right, out=None):
+    """
+    Contract two stacks with `np.einsum`, for equations with repeated indices
+    within a term (e.g. from a fused trace) which `ctg_einsum` does not take.
+    """
+    return np.einsum(batched_eq, stack_left, stack_right, out=out, optimize=True)
+
+@lru_cache(maxsize=None)
+def _get_kernel(eq):
+    """
+    Build the batched contraction kernel for an equation, with the contraction
+    route and the batched equation resolved once rather than on every call.
+
+    Returns
+    -------
+    callable
+        ``kernel(stack_left, stack_right, out=None)``.
+    """
+    gemm = _parse_gemm(eq)
+    if gemm is not None:
+        return partial(_batched_gemm, gemm)
+    inputs = eq.split('->')[0]
+    if any(len(set(term)) != len(term) for term in inputs.split(',')):
+        return partial(_einsum_diagonal, get_batched_einsum_equation(eq, next(_free_symbols(eq))))
+    return partial(_einsum_into, get_batched_einsum_equation(eq))
+
+def _offloaded(eq, batch_size, shape_left, shape_right, backend=None, offload_threshold=2**25):
+    """
+    Whether a batched contraction of `batch_size` operand pairs is offloaded
+    to `backend`, i.e. costs at least `offload_threshold` multiply-adds.
+    """
+    return backend is not None and batch_size * _batched_cost(eq, shape_left, shape_right) >= offload_threshold
+
+def _batched_einsum(eq, stack_left, stack_right, backend=None, offload_threshold=2**25, out=None, device=None):
+    """
+    Perform batched binary contraction for a given equation, optionally
+    writing the result into `out`.
+
+    If `backend` is given and the batched contraction costs at least
+    `offload_threshold` multiply-adds, the stacks are moved to that backend
+    (e.g. 'cupy' or 'torch') for the contraction and the result moved back.
+    If `device` is given, it is passed to the backend's `asarray` when moving
+    the stacks, e.g. `device='cuda'` for torch, whose tensors are otherwise
+    created on the CPU.
+    """
+    B = stack_left.shape[0]
+    if not _offloaded(eq, B, stack_left.shape[1:], stack_right.shape[1:], backend, offload_threshold):
+        return _get_kernel(eq)(stack_left, stack_right, out=out)
+
+    batched_eq = get_batched_einsum_equation(eq, next(_free_symbols(eq)))
+    kwargs = {} if device is None else {"device": device}
+    stack_left = do("asarray", stack_left, like=backend, **kwargs)
+    stack_right = do("asarray", stack_right, like=backend, **kwargs)
+    result = do("to_numpy", do("einsum", batched_eq, stack_left, stack_right, like=backend))
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
+
+def _batched_einsum_generic(eq, arrays_left, arrays_right):
+    """
+    Perform batched binary contraction for operands of any array library
+    known to autoray, e.g. cupy or torch, which the numpy stacking and
+    kernels above would convert or reject.
+    """
     stack_left = do("stack", arrays_left)
     stack_right = do("stack", arrays_right)
+    inputs = eq.split('->')[0]
+    if any(len(set(term)) != len(term) for term in inputs.split(',')):
+        batched_eq = get_batched_einsum_equation(eq, next(_free_symbols(eq)))
+        return do("einsum", batched_eq, stack_left, stack_right)
+    return ctg_einsum(get_batched_einsum_equation(eq), stack_left, stack_right)
 
-    result = ctg_einsum(batched_eq, stack_left, stack_right)
-    for i, (network_idx, parent, left, right) in enumerate(targets):
-        node2array_batch[network_idx][parent] = result[i]
+_TILE_BYTES = 2**23
+
+def _tile_size(eq, arrays_left, arrays_right, backend=None, offload_threshold=2**25):
+    """
+    Return the number of operand pairs per tile of a batched contraction, such
+    that the left and right stacks and the result of a tile fit in `_TILE_BYTES`.
+
+    Contractions offloaded to `backend` are never tiled, both so that the
+    offload threshold applies to the whole batch and so that the stacks are
+    moved to the device in one transfer rather than many small ones.
+    """
+    left, right = arrays_left[0], arrays_right[0]
+    if _offloaded(eq, len(arrays_left), left.shape, right.shape, backend, offload_threshold):
+        return len(arrays_left)
+    result_size = math.prod(get_result_shape(eq, [left.shape, right.shape]))
+    pair_bytes = left.nbytes + right.nbytes + result_size * np.result_type(left.dtype, right.dtype).itemsize
+    return max(1, _TILE_BYTES // max(1, pair_bytes))
 
-def batch_contract(contractions_batch, arrays_batch):
+def batch_contract(contractions_batch, arrays_batch, backend=None, offload_threshold=2**25, alpha=1.0, beta=0.0,
+                   device=None):
     """
     Perform batched contractions for a batch of contractions and their corresponding arrays.
+
+    While one batched contraction runs on the main thread, the operands of
+    the next one are stacked on a worker thread, provided they are already
+    available.
     
     Parameters
     ----------
@@ -153,6 +653,24 @@ def batch_contract(contractions_batch, arrays_batch):
         Each inner list contains tuples of the form (parent, left, right, eq).
     arrays_batch : list of list of arrays
         Each inner list contains arrays corresponding to the contractions.
+        Arrays other than numpy arrays, e.g. from cupy or torch, are
+        contracted with autoray instead of the numpy kernels.
+    backend : optional str
+        An array backend known to autoray, e.g. 'cupy' or 'torch', to offload
+        expensive batched contractions to. Results are always moved back to numpy.
+        Only used for numpy inputs: arrays of other libraries are contracted
+        where they are, and `backend`, `offload_threshold` and `device` are
+        then ignored.
+    offload_threshold : int
+        The minimum number of multiply-adds of a batched contraction for it to
+        be offloaded to `backend`.
+    alpha, beta : float
+        Weights of the scheduling score, `alpha * batch_size - beta * delta_bytes`.
+        See `get_batched_contractions`.
+    device : optional str
+        The device to move offloaded stacks to, passed to the backend's
+        `asarray`, e.g. 'cuda' for torch. By default the backend's own default
+        device is used, which for torch is the CPU.
 
     Returns
     -------
@@ -160,21 +678,223 @@ def batch_contract(contractions_batch, arrays_batch):
         Each dict contains the updated arrays after performing the batched contractions.
     """
     shapes_batch = [[array.shape for array in arrays] for arrays in arrays_batch]
-    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch)
+    native = all(isinstance(array, np.ndarray) for arrays in arrays_batch for array in arrays)
+    if native:
+        dtypes_batch = [[array.dtype for array in arrays] for arrays in arrays_batch]
+    else:
+        dtypes_batch = [[do("get_dtype_name", array) for array in arrays] for arrays in arrays_batch]
+    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch, dtypes_batch, alpha, beta)
+
+    node2array_batch = [{_leaf(n): arr for n, arr in enumerate(arrays)} for arrays in arrays_batch]
+
+    # Single term steps, e.g. 'ii->i', are not batched but applied directly
+    # to the input they replace.
+    single_steps = {}
+    for contractions, node2array in zip(contractions_batch, node2array_batch):
+        steps = single_steps.get(id(contractions))
+        if steps is None:
+            steps = single_steps[id(contractions)] = [
+                (parent, eq) for parent, left, right, eq in contractions if left is None and right is None
+            ]
+        for parent, eq in steps:
+            node2array[parent] = do("einsum", eq, node2array[parent])
+
+    if not native:
+        # Other array libraries are stacked and contracted with autoray,
+        # without tiling, prefetching or offloading.
+        for eq, targets in batched_contractions:
+            arrays_left, arrays_right, inverse = _pop_inputs(targets, node2array_batch)
+            result = _batched_einsum_generic(eq, arrays_left, arrays_right)
+            rows = [result[k] for k in range(len(arrays_left))]
+            for i, (network_idx, parent, left, right) in enumerate(targets):
+                node2array_batch[network_idx][parent] = rows[inverse[i]]
+            del arrays_left, arrays_right, result, rows
+        return [next(iter(node2array.values())) for node2array in node2array_batch]
+
+    # Batched outputs produced here, the only buffers operands are gathered from.
+    outputs = {}
 
-    node2array_batch = [{frozenset([n]): arr for n, arr in enumerate(arrays)} for arrays in arrays_batch]
+    # A single batched contraction has nothing to overlap with.
+    pool = ThreadPoolExecutor(max_workers=1) if len(batched_contractions) > 1 else None
+    try:
+        prefetched = None
+        for k, (eq, targets) in enumerate(batched_contractions):
+            if prefetched is None:
+                arrays_left, arrays_right, inverse = _pop_inputs(targets, node2array_batch)
+                tile = _tile_size(eq, arrays_left, arrays_right, backend, offload_threshold)
+                next_stacks = None
+            else:
+                arrays_left, arrays_right, inverse, tile, next_stacks = prefetched
+            prefetched = None
 
-    for eq, targets in batched_contractions:
-        _batched_einsum(eq, targets, node2array_batch)
+            # Large batches are streamed in tiles that fit in cache, each one
+            # contracted into its slice of a single preallocated output.
+            U = len(arrays_left)
+            logger.debug("Contracting %s on batch %d (%d unique) in tiles of %d", eq, len(targets), U, tile)
+            out = None
+            if tile < U:
+                result_shape = get_result_shape(eq, [arrays_left[0].shape, arrays_right[0].shape])
+                dtype = np.result_type(*(array.dtype for array in arrays_left + arrays_right))
+                out = np.empty((U,) + tuple(result_shape), dtype=dtype)
+
+            for start in range(0, U, tile):
+                stop = start + tile
+                if next_stacks is None:
+                    stacks = _stack_inputs(arrays_left[start:stop], arrays_right[start:stop], outputs)
+                else:
+                    stacks = next_stacks.result()
+
+                # Prefetch the next tile, or the first tile of the next batched
+                # contraction unless its operands are produced by this one,
+                # while this tile is contracted on the main thread. Arrays are
+                # only ever popped here on the main thread.
+                next_stacks = None
+                if pool is not None and stop < U:
+                    next_stacks = pool.submit(
+                        _stack_inputs, arrays_left[stop:stop + tile], arrays_right[stop:stop + tile], outputs
+                    )
+                elif pool is not None and k + 1 < len(batched_contractions):
+                    next_eq, next_targets = batched_contractions[k + 1]
+                    if all(
+                        left in node2array_batch[network_idx] and right in node2array_batch[network_idx]
+                        for network_idx, _, left, right in next_targets
+                    ):
+                        next_left, next_right, next_inverse = _pop_inputs(next_targets, node2array_batch)
+                        next_tile = _tile_size(next_eq, next_left, next_right, backend, offload_threshold)
+                        next_future = pool.submit(
+                            _stack_inputs, next_left[:next_tile], next_right[:next_tile], outputs
+                        )
+                        prefetched = (next_left, next_right, next_inverse, next_tile, next_future)
+                        del next_left, next_right, next_future
+
+                out_tile = None if out is None else out[start:stop]
+                result = _batched_einsum(eq, *stacks, backend, offload_threshold, out_tile, device)
+                del stacks
+            del arrays_left, arrays_right
+
+            # Store C-contiguous results, in a single pass over the batch, so a
+            # permuted stride pattern is not inherited by every later operand.
+            # Duplicated targets share the same row object, so they are
+            # recognised as identical operands further up the tree too.
+            rows = list(np.ascontiguousarray(result) if out is None else out)
+            if rows and isinstance(rows[0].base, np.ndarray):
+                outputs[id(rows[0].base)] = weakref.ref(rows[0].base)
+            for i, (network_idx, parent, left, right) in enumerate(targets):
+                node2array_batch[network_idx][parent] = rows[inverse[i]]
+
+            # Leave the row views as the only references to the batched output,
+            # so its buffer is freed as soon as the last row is consumed.
+            del result, out, out_tile, rows
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     return [next(iter(node2array.values())) for node2array in node2array_batch]
 
+def _free_symbols(eq):
+    """
+    Generate the einsum symbols not used in `eq`.
+    """
+    return (c for c in map(get_symbol, itertools.count()) if c not in eq)
+
+def _fuse_single_term(single_eq, eq, position):
+    """
+    Fuse a single term equation into the operand at `position` of a pairwise
+    equation, so the pairwise contraction consumes the raw operand directly.
+    e.g. ("aab->ab", "ab,bc->ac", 0) -> "aab,bc->ac".
+    """
+    single_input, single_output = single_eq.split('->')
+    inputs, output = eq.split('->')
+    terms = inputs.split(',')
+
+    symbols = dict(zip(single_output, terms[position]))
+    free_symbols = _free_symbols(eq)
+    for c in single_input:
+        if c not in symbols:
+            symbols[c] = next(free_symbols)
+
+    terms[position] = ''.join(symbols[c] for c in single_input)
+    return f"{','.join(terms)}->{output}"
+
+def _size_class(size):
+    """
+    Round a dimension size up to the next power of two.
+    """
+    return 1 << (size - 1).bit_length() if size > 1 else size
+
+# The maximum relative increase in cost over the optimal tree accepted when
+# reusing the tree of another member of a shape family.
+_TREE_TOLERANCE = 0.05
+
+# The first shapes, contractions and width seen for each shape family, keyed by
+# the equation and the shapes rounded up to powers of two.
+_FAMILY_TREES = {}
+
+def _contraction_width(contractions):
+    """
+    The largest number of distinct indices of any contraction.
+    """
+    return max((len(set(eq.replace(',', '').replace('->', ''))) for *_, eq in contractions), default=0)
+
+def _size_ratio(shapes, other_shapes):
+    """
+    The largest factor by which any size differs between two lists of shapes.
+    """
+    ratio = 1.0
+    for shape, other_shape in zip(shapes, other_shapes):
+        for a, b in zip(shape, other_shape):
+            if a != b:
+                ratio = max(ratio, max(a, b) / min(a, b) if min(a, b) > 0 else math.inf)
+    return ratio
+
 @lru_cache(maxsize=None)
 def get_contractions(eq, *shapes):
+    # The contractions only depend on the shapes through the choice of tree,
+    # so near-identical shape families such as (1000, 200) and (1001, 200)
+    # can share one. The tree is found for the real shapes of the first member
+    # of a family, and only reused for a later member if it is provably within
+    # `_TREE_TOLERANCE` of optimal there: with every size within a factor `r`
+    # and at most `w` indices per contraction, costs change by at most `r**w`
+    # either way, so the reused tree costs at most `r**(2*w)` times the optimum.
+    family = (eq,) + tuple(tuple(_size_class(d) for d in shape) for shape in shapes)
+    if family not in _FAMILY_TREES:
+        contractions = _get_contractions(eq, *shapes)
+        _FAMILY_TREES[family] = (shapes, contractions, _contraction_width(contractions))
+        return contractions
+
+    family_shapes, contractions, width = _FAMILY_TREES[family]
+    if _size_ratio(shapes, family_shapes) ** (2 * width) <= 1 + _TREE_TOLERANCE:
+        return contractions
+    return _get_contractions(eq, *shapes)
+
+@lru_cache(maxsize=None)
+def _get_contractions(eq, *shapes):
     tree = einsum_tree(eq, *shapes)
-    return [(c[0], c[1], c[2], c[4]) for c in extract_contractions(tree, prefer_einsum=True)]
+    contractions = [(c[0], c[1], c[2], c[4]) for c in extract_contractions(tree, prefer_einsum=True)]
+
+    # Single term simplifications (traces, sums over indices appearing once)
+    # are fused into the pairwise contraction consuming them rather than
+    # materialized as separate intermediates.
+    # Steps without a pairwise consumer, such as the whole of a single input
+    # equation like 'ii->i', are kept to be applied on their own.
+    single_eqs = {parent: eq for parent, left, right, eq in contractions if left is None and right is None}
+    if len(shapes) == 1 and not contractions:
+        inputs, output = eq.split('->')
+        if inputs != output:
+            single_eqs[_leaf(0)] = eq
+    consumed = {node for _, left, right, _ in contractions if left is not None for node in (left, right)}
+    fused = [(parent, None, None, eq) for parent, eq in single_eqs.items() if parent not in consumed]
+    for parent, left, right, eq in contractions:
+        if left is None or right is None:
+            continue
+        if left in single_eqs:
+            eq = _fuse_single_term(single_eqs[left], eq, 0)
+        if right in single_eqs:
+            eq = _fuse_single_term(single_eqs[right], eq, 1)
+        fused.append((parent, left, right, eq))
+    return fused
 
-def batch_einsum(eq_batch, arrays_batch):
+def batch_einsum(eq_batch, arrays_batch, backend=None, offload_threshold=2**25, alpha=1.0, beta=0.0, device=None):
     """
     Perform batched einsum for a list of equations and their corresponding arrays.
     
@@ -184,6 +904,19 @@ def batch_einsum(eq_batch, arrays_batch):
         List of einsum equations, e.g., ["ij,jk->ik", "ab,bc->ac"].
     arrays : list of list of arrays
         Each inner list contains arrays corresponding to the equations.
+    backend : optional str
+        An array backend known to autoray, e.g. 'cupy' or 'torch', to offload
+        expensive batched contractions to. Only used for numpy inputs; see
+        `batch_contract`.
+    offload_threshold : int
+        The minimum number of multiply-adds of a batched contraction for it to
+        be offloaded to `backend`.
+    alpha, beta : float
+        Weights of the scheduling score, `alpha * batch_size - beta * delta_bytes`.
+        A positive `beta` trades batch size for lower peak memory.
+    device : optional str
+        The device to move offloaded stacks to, e.g. 'cuda' for torch.
+        See `batch_contract`.
 
     Returns
     -------
@@ -193,4 +926,4 @@ def batch_einsum(eq_batch, arrays_batch):
     shapes_batch = [[array.shape for array in arrays] for arrays in arrays_batch]
     contractions_batch = [get_contractions(eq, *shapes) for eq, shapes in zip(eq_batch, shapes_batch)]
 
-    return batch_contract(contractions_batch, arrays_batch)
+    return batch_contract(contractions_batch, arrays_batch, backend, offload_threshold, alpha, beta, device)
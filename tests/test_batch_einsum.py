@@ -1,5 +1,8 @@
+import importlib
 from batch_tn import batch_einsum
+from batch_tn.batch_einsum import batch_contract, get_batched_contractions
 import numpy as np
+import pytest
 
 def test_batch_einsum():
     eq = 'ij,jk->ik'
@@ -15,3 +18,276 @@ def test_batch_einsum():
     # check that the result matches with the numpy einsum
     expected = np.einsum(eq, *arrays)
     assert np.allclose(results[0], expected)
+
+def test_batch_einsum_mixed_equations():
+    eqs = [
+        'ij,jk->ik',
+        'ij,jk->ki',
+        'abc,cbd->da',
+        'ij,ij->i',
+        'i,ikj,j->k',
+        'ab,bc,cd->ad',
+    ]
+    size_dict = {c: 2 + n for n, c in enumerate('abcdijk')}
+
+    arrays_batch = []
+    for eq in eqs:
+        terms = eq.split('->')[0].split(',')
+        arrays_batch.append([np.random.rand(*(size_dict[c] for c in term)) for term in terms])
+
+    results = batch_einsum(eqs * 3, arrays_batch * 3)
+    for eq, arrays, res in zip(eqs * 3, arrays_batch * 3, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_single_term_simplifications():
+    eqs = ['iij,jk->ik', 'ij,jk,kl->', 'abc,cd->ad']
+    shapes_list = [
+        [(3, 3, 4), (4, 5)],
+        [(2, 3), (3, 4), (4, 5)],
+        [(2, 3, 4), (4, 5)],
+    ]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+
+    results = batch_einsum(eqs * 2, arrays_batch * 2)
+    for eq, arrays, res in zip(eqs * 2, arrays_batch * 2, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_single_input():
+    eqs = ['ii->i', 'ij->ji', 'ij->', 'ij->ij']
+    shapes_list = [[(3, 3)], [(3, 4)], [(3, 4)], [(3, 4)]]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+
+    results = batch_einsum(eqs * 2, arrays_batch * 2)
+    for eq, arrays, res in zip(eqs * 2, arrays_batch * 2, results):
+        assert res.shape == np.einsum(eq, *arrays).shape
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_mixed_dtypes():
+    eq = 'ij,jk->ik'
+    arrays_32 = [np.random.rand(2, 3).astype(np.float32), np.random.rand(3, 4).astype(np.float32)]
+    arrays_64 = [np.random.rand(2, 3), np.random.rand(3, 4)]
+
+    results = batch_einsum([eq] * 2, [arrays_32, arrays_64])
+    assert results[0].dtype == np.float32
+    assert results[1].dtype == np.float64
+    assert np.allclose(results[0], np.einsum(eq, *arrays_32), atol=1e-6)
+    assert np.allclose(results[1], np.einsum(eq, *arrays_64))
+
+def test_batch_einsum_offload_backend():
+    eqs = ['ij,jk->ik', 'iij,jk->ik']
+    shapes_list = [[(2, 3), (3, 4)], [(3, 3, 4), (4, 5)]]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+
+    results = batch_einsum(eqs * 2, arrays_batch * 2, backend='numpy', offload_threshold=0)
+    for eq, arrays, res in zip(eqs * 2, arrays_batch * 2, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_offload_whole_batch(monkeypatch):
+    module = importlib.import_module('batch_tn.batch_einsum')
+    monkeypatch.setattr(module, '_TILE_BYTES', 1)
+    calls = []
+    do = module.do
+    monkeypatch.setattr(module, 'do', lambda fn, *args, **kwargs: calls.append(fn) or do(fn, *args, **kwargs))
+
+    eq = 'ij,jk->ik'
+    arrays_batch = [[np.random.rand(2, 3), np.random.rand(3, 4)] for _ in range(6)]
+
+    # each pair costs 24 multiply-adds, so only the whole batch reaches the
+    # threshold, and it is offloaded in one call rather than tiled
+    results = batch_einsum([eq] * 6, arrays_batch, backend='numpy', offload_threshold=100)
+    assert calls.count('einsum') == 1
+    for arrays, res in zip(arrays_batch, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+    calls.clear()
+    results = batch_einsum([eq] * 6, arrays_batch, backend='numpy', offload_threshold=1000)
+    assert calls.count('einsum') == 0
+    for arrays, res in zip(arrays_batch, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_offload_torch():
+    torch = pytest.importorskip('torch')
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    eqs = ['ij,jk->ik', 'iij,jk->ik']
+    shapes_list = [[(2, 3), (3, 4)], [(3, 3, 4), (4, 5)]]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+
+    results = batch_einsum(eqs * 2, arrays_batch * 2, backend='torch', offload_threshold=0, device=device)
+    for eq, arrays, res in zip(eqs * 2, arrays_batch * 2, results):
+        assert isinstance(res, np.ndarray)
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_einsum_torch_inputs():
+    torch = pytest.importorskip('torch')
+
+    eqs = ['ij,jk->ik', 'iij,jk->ik', 'ab,ab,c->c']
+    shapes_list = [[(2, 3), (3, 4)], [(3, 3, 4), (4, 5)], [(2, 3), (2, 3), (4,)]]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+    tensors_batch = [[torch.from_numpy(array) for array in arrays] for arrays in arrays_batch]
+
+    results = batch_einsum(eqs * 2, tensors_batch * 2)
+    for eq, arrays, res in zip(eqs * 2, arrays_batch * 2, results):
+        assert isinstance(res, torch.Tensor)
+        assert np.allclose(res.numpy(), np.einsum(eq, *arrays))
+
+def test_batch_einsum_tiled(monkeypatch):
+    module = importlib.import_module('batch_tn.batch_einsum')
+    monkeypatch.setattr(module, '_TILE_BYTES', 1)
+
+    eqs = ['ab,bc,cd->ad', 'ab,bc->ca', 'iij,jk->ik']
+    shapes_list = [[(2, 3), (3, 4), (4, 5)], [(2, 3), (3, 4)], [(3, 3, 4), (4, 5)]]
+    arrays_batch = [
+        [np.random.rand(*shape) for shape in shapes]
+        for shapes in shapes_list
+        for _ in range(4)
+    ]
+    eq_batch = [eq for eq in eqs for _ in range(4)]
+
+    results = batch_einsum(eq_batch, arrays_batch)
+    for eq, arrays, res in zip(eq_batch, arrays_batch, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+def test_batch_contract_gathered_rows(monkeypatch):
+    taken = []
+    take = np.take
+    monkeypatch.setattr(np, 'take', lambda *args, **kwargs: taken.append(args[1]) or take(*args, **kwargs))
+
+    # both trees share their first two leaves, so their first contraction is
+    # computed once and its single row is gathered twice for the second one
+    contractions = [
+        (frozenset([0, 1]), frozenset([0]), frozenset([1]), 'ab,bc->ac'),
+        (frozenset([0, 1, 2]), frozenset([0, 1]), frozenset([2]), 'ac,cd->ad'),
+    ]
+    a, b = np.random.rand(2, 3), np.random.rand(3, 4)
+    arrays_batch = [[a, b, np.random.rand(4, 5)], [a, b, np.random.rand(4, 5)]]
+
+    results = batch_contract([contractions] * 2, arrays_batch)
+    assert [0, 0] in taken
+    for arrays, res in zip(arrays_batch, results):
+        assert np.allclose(res, np.einsum('ab,bc,cd->ad', *arrays))
+
+def test_get_contractions_size_classes():
+    module = importlib.import_module('batch_tn.batch_einsum')
+    module.get_contractions.cache_clear()
+    module._get_contractions.cache_clear()
+    module._FAMILY_TREES.clear()
+
+    eq = 'ab,bc->ac'
+    shapes_list = [[(1000, 200), (200, 3)], [(1001, 200), (200, 3)]]
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_list]
+
+    results = batch_einsum([eq] * 2, arrays_batch)
+    assert module.get_contractions.cache_info().misses == 2
+    assert module._get_contractions.cache_info().misses == 1
+    for arrays, res in zip(arrays_batch, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))
+
+    # the tree is searched again for a member of the same family whose sizes
+    # differ too much for the shared tree to be within tolerance
+    module.get_contractions(eq, (600, 200), (200, 3))
+    assert module._get_contractions.cache_info().misses == 2
+
+def test_batch_einsum_caller_views():
+    # operands that are views of the caller's own buffers are copied, never
+    # gathered as if they were rows of a batched output
+    owner = np.random.rand(8, 5)
+    flat = owner.reshape(-1)
+    matrix = np.random.rand(5, 4)
+    arrays_batch = [[flat[1 + 5 * k:6 + 5 * k], matrix] for k in range(3)]
+
+    results = batch_einsum(['b,bc->c'] * 3, arrays_batch)
+    for (vector, _), res in zip(arrays_batch, results):
+        assert np.allclose(res, vector @ matrix)
+
+    ints = np.arange(12, dtype=np.int64).reshape(3, 4) * 1000
+    floats = ints.view(np.float64)
+    arrays_batch = [[floats[k], matrix[:4]] for k in (2, 0)]
+
+    results = batch_einsum(['b,bc->c'] * 2, arrays_batch)
+    for (vector, _), res in zip(arrays_batch, results):
+        assert np.array_equal(res, vector @ matrix[:4])
+
+def test_batched_contractions_canonical_signatures():
+    contractions_batch = [
+        [(frozenset([0, 1]), frozenset([0]), frozenset([1]), 'ab,bc->ac')],
+        [(frozenset([0, 1]), frozenset([0]), frozenset([1]), 'bc,ab->ac')],
+        [(frozenset([0, 1]), frozenset([0]), frozenset([1]), 'ij,jk->ik')],
+    ]
+    shapes_batch = [[(2, 3), (3, 4)], [(3, 4), (2, 3)], [(2, 3), (3, 4)]]
+
+    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch)
+    assert len(batched_contractions) == 1
+    assert len(batched_contractions[0][1]) == 3
+
+    arrays_batch = [[np.random.rand(*shape) for shape in shapes] for shapes in shapes_batch]
+    results = batch_contract(contractions_batch, arrays_batch)
+    for contractions, arrays, res in zip(contractions_batch, arrays_batch, results):
+        assert np.allclose(res, np.einsum(contractions[0][3], *arrays))
+
+def test_batched_contractions_opaque_dtypes():
+    # dtype names of other libraries, e.g. torch's bfloat16, are not known to
+    # numpy and are only used as keys
+    contractions = [
+        (frozenset([0, 1]), frozenset([0]), frozenset([1]), 'ab,bc->ac'),
+        (frozenset([0, 1, 2]), frozenset([0, 1]), frozenset([2]), 'ac,cd->ad'),
+    ]
+    shapes = [(2, 3), (3, 4), (4, 5)]
+    dtypes_batch = [
+        ['bfloat16', 'bfloat16', 'bfloat16'],
+        ['bfloat16', 'bfloat16', 'bfloat16'],
+        ['bfloat16', 'float32', 'float32'],
+    ]
+
+    batched_contractions = get_batched_contractions([contractions] * 3, [shapes] * 3, dtypes_batch, beta=1.0)
+    assert sorted(len(targets) for _, targets in batched_contractions) == [1, 1, 2, 2]
+
+def test_batched_contractions_memory_aware_order():
+    leaves = [frozenset([0]), frozenset([1]), frozenset([2])]
+    outer = [(frozenset([0, 1]), leaves[0], leaves[1], 'a,b->ab')]
+    reduce = [
+        (frozenset([0, 1]), leaves[0], leaves[1], 'a,b->ab'),
+        (frozenset([0, 1, 2]), frozenset([0, 1]), leaves[2], 'ab,ab->'),
+    ]
+    contractions_batch = [outer] * 2 + [reduce]
+    shapes_batch = [[(30,), (30,)]] * 2 + [[(20,), (20,), (20, 20)]]
+
+    # largest batch first by default, the contraction releasing its
+    # intermediate operand as soon as it is ready with beta > 0
+    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch)
+    assert [len(targets) for _, targets in batched_contractions] == [2, 1, 1]
+
+    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch, beta=1.0)
+    assert [len(targets) for _, targets in batched_contractions] == [1, 1, 2]
+
+    # input arrays are held by the caller, so contracting two large leaves
+    # into a scalar allocates memory rather than releasing it
+    small = [(frozenset([0, 1]), leaves[0], leaves[1], 'a,a->')]
+    large = [(frozenset([0, 1]), leaves[0], leaves[1], 'ab,ab->')]
+    contractions_batch = [small] * 2 + [large]
+    shapes_batch = [[(1,), (1,)]] * 2 + [[(10, 10), (10, 10)]]
+
+    batched_contractions = get_batched_contractions(contractions_batch, shapes_batch, beta=0.01)
+    assert [len(targets) for _, targets in batched_contractions] == [2, 1]
+
+def test_schedule_ignores_stale_entries():
+    module = importlib.import_module('batch_tn.batch_einsum')
+
+    # signature 2 is ready with one node, grows to two and is contracted, then
+    # regrows to one node with a low score: the stale entry from its first
+    # node, of the same size, must not schedule it ahead of signature 3
+    node_parent = [2, 3, 4, 4, -1, -1]
+    node_sig = [0, 1, 2, 2, 2, 3]
+    node_pending = [0, 0, 1, 1, 2, 0]
+    node_scores = [100.0, 90.0, 50.0, 10.0, -100.0, 20.0]
+
+    order = module._schedule(node_parent, node_sig, node_pending, [1] * 6, node_scores)
+    assert order == [(0, [0]), (1, [1]), (2, [2, 3]), (3, [5]), (2, [4])]
+
+def test_batch_einsum_scalar_intermediates():
+    eq = 'ab,ab,c->c'
+    arrays_batch = [[np.random.rand(2, 3), np.random.rand(2, 3), np.random.rand(4)] for _ in range(3)]
+
+    results = batch_einsum([eq] * 3, arrays_batch)
+    for arrays, res in zip(arrays_batch, results):
+        assert np.allclose(res, np.einsum(eq, *arrays))